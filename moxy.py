@@ -13,22 +13,42 @@
 # Copyright © 2020–2021 Wolt Enterprises
 #
 
+import copy
+import functools
+import itertools
 import json
 import os
+import queue
 import random
 import re
-from collections import OrderedDict
-from typing import Optional, Tuple, Union
+import sys
+import threading
+import time
+from collections import ChainMap, defaultdict
+from typing import Callable, Optional, Tuple, Union
 from mitmproxy import http
 from mitmproxy import ctx
+from mitmproxy import io
 from mitmproxy import net
 
-def host_matches(host: str, allow) -> bool:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+def compile_host_matcher(allow) -> Optional[tuple]:
     """
-    Returns whether `host` matches `allow`.
+    Returns a precompiled matcher for the host pattern(s) `allow`, to be used
+    with `host_matches`, or `None` if all hosts are allowed.
 
     `allow` may be a string pattern, or a list of such patterns, in which
-    case returns True if `host` matches any pattern in `allow`.
+    case a host matches if it matches any pattern in `allow`.
 
     - If the pattern begins with a dot, `host` must end with the suffix
       following the dot
@@ -36,37 +56,75 @@ def host_matches(host: str, allow) -> bool:
     - If the patterns begins with a tilde, the rest of the pattern is treated as
       a regular expression that must be found in `host`
     - Otherwise `host` must equal the pattern
+
+    The patterns are sorted into a tuple of exact hosts, suffixes, prefixes,
+    and regular expressions, so that matching needs no per-pattern parsing.
     """
-    if isinstance(allow, str):
-        if allow.startswith("."):
-            return host.endswith(allow[1:])
-        elif allow.endswith("."):
-            return host.startswith(allow)
-        elif allow.startswith("~"):
-            return bool(compiled_re_for(allow[1:]).search(host))
+    if allow is None:
+        return None
+    exact, suffixes, prefixes, regexes = set(), [], [], []
+    patterns = [ allow ]
+    while patterns:
+        pattern = patterns.pop()
+        if isinstance(pattern, str):
+            if pattern.startswith("."):
+                suffixes.append(pattern[1:])
+            elif pattern.endswith("."):
+                prefixes.append(pattern)
+            elif pattern.startswith("~"):
+                regexes.append(pattern[1:])
+            else:
+                exact.add(pattern)
+        elif isinstance(pattern, dict):
+            exact.update(host for host, allowed in pattern.items() if allowed)
         else:
-            return host == allow
-    elif isinstance(allow, dict):
-        return bool(allow.get(host, False))
-    elif allow is None:
+            patterns.extend(pattern)
+    return (frozenset(exact), tuple(suffixes), tuple(prefixes), compiled_re_union(regexes))
+
+def compiled_re_union(re_strs: list) -> tuple:
+    """
+    Returns a tuple of compiled regular expressions that together find the
+    same strings as any of `re_strs`. Where possible, the expressions are
+    combined into a single alternation so that only one search is needed.
+    Expressions containing backreferences or conditionals are kept separate,
+    since their group numbers would change inside the alternation, as are
+    expressions with global inline flags, which would apply to all of them
+    (see `UNCOMBINABLE_RE_SYNTAX_RE`).
+    """
+    if len(re_strs) > 1 and not any(UNCOMBINABLE_RE_SYNTAX_RE.search(re_str) for re_str in re_strs):
+        try:
+            # The newline terminates any verbose mode comment in a pattern
+            return (compiled_re_for("|".join(f"(?:{re_str}\n)" for re_str in re_strs)),)
+        except re.error:
+            pass
+    return tuple(compiled_re_for(re_str) for re_str in re_strs)
+
+def host_matches(host: str, matcher: Optional[tuple]) -> bool:
+    """
+    Returns whether `host` matches `matcher`, as compiled by
+    `compile_host_matcher`.
+    """
+    if matcher is None:
         return True
-    else:
-        for allowed_host in allow:
-            if host_matches(host, allowed_host):
-                return True
+    exact, suffixes, prefixes, regexes = matcher
+    if host in exact or host.endswith(suffixes) or host.startswith(prefixes):
+        return True
+    for regex in regexes:
+        if regex.search(host):
+            return True
     return False
 
+@functools.lru_cache(maxsize=1024)
 def compiled_re_for(re_str: str):
     """
     Returns a compiled regular expression object for the string `re_str`.
-    The compiled regular expressions are cached in memory.
+    The most recently used compiled regular expressions are cached in memory.
+
+    The expressions are compiled in verbose mode, but since that only affects
+    whitespace and comments, the flag is omitted from expressions with
+    neither.
     """
-    global re_cache
-    result = re_cache.get(re_str)
-    if result is None:
-        result = re.compile(re_str, re.X)
-        re_cache[re_str] = result
-    return result
+    return re.compile(re_str, re.X if VERBOSE_SYNTAX_RE.search(re_str) else 0)
 
 def matches_value_or_list(value, allow) -> bool:
     """
@@ -75,71 +133,234 @@ def matches_value_or_list(value, allow) -> bool:
     `allow` may either be of the same type as `value`, or a list of such items,
     in which case returns True if `value` matches any element of `allow`. In
     case of strings, value may have a tilde prefix (`~`) in which case its
-    suffix is treated as a regular expression.
+    suffix is treated as a regular expression. Plain values and lists of them
+    are converted to a `frozenset` by `compile_value_list` when the
+    configuration is loaded, and are matched by membership. Likewise the regular expressions
+    are compiled by `compile_patterns` when the configuration is loaded.
+
+    The matching is dispatched on the exact class of `allow` through
+    `VALUE_MATCHERS`, defaulting to `matches_value_in_list`.
     """
-    if type(value) is type(allow):
-        if isinstance(allow, str) and allow.startswith("~"):
+    return VALUE_MATCHERS.get(allow.__class__, matches_value_in_list)(value, allow)
+
+def matches_value_in_set(value, allow: frozenset) -> bool:
+    """
+    Returns whether `value`, or its string representation, is in the set
+    `allow` (see `matches_value_or_list`).
+    """
+    if isinstance(value, str):
+        return value in allow
+    try:
+        if value in allow:
+            return True
+    except TypeError:
+        pass
+    return str(value) in allow
+
+def matches_value_pattern(value, allow: re.Pattern) -> bool:
+    """
+    Returns whether the string `value` matches the regular expression `allow`
+    (see `matches_value_or_list`).
+    """
+    return isinstance(value, str) and (bool(allow.search(value)) or value == f"~{allow.pattern}")
+
+def matches_value_str(value, allow: str) -> bool:
+    """
+    Returns whether `value` matches the string `allow`, which may have the
+    regular expression prefix `~` (see `matches_value_or_list`).
+    """
+    if type(value) is str:
+        if allow.startswith("~"):
             return (value == allow) or bool(compiled_re_for(allow[1:]).search(value))
-        else:
-            return value == allow
-    elif isinstance(allow, dict):
-        return allow.get(value, False)
-    elif isinstance(allow, str):
-        return allow == str(value)
-    else:
-        for allowed in allow:
-            if matches_value_or_list(value, allowed):
-                return True
+        return value == allow
+    return allow == str(value)
+
+def matches_value_dict(value, allow: dict) -> bool:
+    """
+    Returns whether `value` is equal to `allow`, or is a key in `allow` with
+    a truthy value (see `matches_value_or_list`).
+    """
+    if type(value) is dict:
+        return value == allow
+    return allow.get(value, False)
+
+def matches_value_in_list(value, allow) -> bool:
+    """
+    Returns whether `value` is equal to `allow`, or matches any element of
+    `allow` (see `matches_value_or_list`).
+    """
+    if type(value) is type(allow):
+        return value == allow
+    for allowed in allow:
+        if matches_value_or_list(value, allowed):
+            return True
     return False
 
-def request_matches_config(request: http.Request, config: dict) -> bool:
+def compile_value_list(allow):
+    """
+    Returns `allow` as a `frozenset` if it is a plain string (i.e., without
+    the regular expression prefix `~`), an integer, or a list of either,
+    since matching against such a value is a membership test. Otherwise
+    returns `allow` unchanged.
     """
-    Returns whether `request` is matched by `config`. This checks the following:
+    if allow and ((isinstance(allow, str) and not allow.startswith("~")) or type(allow) is int):
+        return frozenset((allow,))
+    if isinstance(allow, list) and allow:
+        if all(isinstance(value, str) and not value.startswith("~") for value in allow):
+            return frozenset(allow)
+        if all(type(value) is int for value in allow):
+            return frozenset(allow)
+    return allow
 
-    - `host` (some patterns supported, see `host_matches`)
+def compile_patterns(allow, is_content: bool = False):
+    """
+    Returns `allow` with the strings prefixed with a tilde (`~`) replaced by
+    their compiled regular expressions, including the elements of lists and,
+    if `is_content`, the values of dictionaries (see `is_subset`). Strings
+    that are not valid regular expressions are left as is.
+    """
+    if isinstance(allow, str):
+        if allow.startswith("~"):
+            try:
+                return compiled_re_for(allow[1:])
+            except re.error:
+                pass
+    elif isinstance(allow, list):
+        return [ compile_patterns(allowed, is_content) for allowed in allow ]
+    elif is_content and isinstance(allow, dict):
+        return { key: compile_patterns(value, is_content) for key, value in allow.items() }
+    return allow
+
+def order_content_matchers(allow):
+    """
+    Returns the content matcher `allow` (see `content_matches`) with the
+    elements of a list ordered from the cheapest to the most expensive to
+    match: plain substrings first, then regular expressions, and objects
+    (which require parsing the content) last. Since all elements must match,
+    the order does not affect the result, only how soon a mismatch is found.
+    """
+    if not isinstance(allow, list):
+        return allow
+    def cost(allowed) -> int:
+        if isinstance(allowed, str):
+            return 1 if allowed.startswith("~") else 0
+        elif isinstance(allowed, re.Pattern):
+            return 1
+        return 2
+    return sorted(allow, key=cost)
+
+def query_matches(query, required_query: tuple) -> bool:
+    """
+    Returns whether the request `query` is matched by `required_query`, as
+    compiled by `compile_query`.
+    """
+    for key, value_matches in required_query:
+        value = query.get(key)
+        if value is None or not value_matches(value):
+            return False
+    return True
+
+def state_matches(request: http.Request, config: dict, required_state) -> bool:
+    """
+    Returns whether the global `mock_state` is matched by `required_state`,
+    i.e., the `require` part of the handler `config` for `request`.
+    """
+    if isinstance(required_state, dict):
+        for variable, required_value in required_state.items():
+            value = mock_state.get(variable, "")
+            if not matches_value_or_list(value, required_value):
+                return False
+        return True
+    variable = config["variable"] if "variable" in config else request.path.partition("?")[0]
+    return matches_value_or_list(mock_state.get(variable, ""), required_state)
+
+def compile_request_matcher(config: dict, host_matcher: Optional[tuple], required_scheme) -> Callable[[http.Request], bool]:
+    """
+    Returns a function that returns whether a request is matched by the
+    handler `config`, performing only the checks that `config` requires of
+    the following:
+
+    - `host` (some patterns supported, see `compile_host_matcher`)
     - `scheme` (exact match or list)
     – `method` (exact match or list)
     - `path` (exact match or list, normally matched already before coming here)
     - `query` (keys are exact, values either exact or list)
     – `request` (the content of the request body)
     – `require` (dictionary from variable names to required values)
+
+    The `host_matcher` and `required_scheme` are the defaults used unless
+    `config` specifies the host or scheme. An empty handler (i.e., one with
+    only the keys added when compiling it) matches no requests.
     """
-    if not config:
-        return False
-    host_whitelist = config.get("host", mock_config.get("host"))
-    if not host_matches(str(request.host), host_whitelist):
-        return False
-    required_scheme = config.get("scheme", mock_config.get("scheme"))
-    if required_scheme and not matches_value_or_list(request.scheme, required_scheme):
-        return False
+    if config.keys() <= INTERNAL_HANDLER_KEYS:
+        return lambda request: False
+    checks = []
+    if "_host" in config:
+        host_matcher = config["_host"]
+    if host_matcher is not None:
+        exact_hosts, suffixes, prefixes, regexes = host_matcher
+        if not (suffixes or prefixes or regexes):
+            checks.append(lambda request: str(request.host) in exact_hosts)
+        else:
+            checks.append(lambda request: host_matches(str(request.host), host_matcher))
+    required_scheme = config.get("scheme", required_scheme)
+    if required_scheme:
+        if type(required_scheme) is int:
+            checks.append(lambda request: bool(SCHEME_BITS.get(request.scheme, 0) & required_scheme))
+        else:
+            scheme_matches = compile_str_matcher(required_scheme)
+            checks.append(lambda request: scheme_matches(request.scheme))
     required_method = config.get("method")
-    if required_method and not matches_value_or_list(request.method, required_method):
-        return False
+    if required_method:
+        method_matches = compile_str_matcher(required_method)
+        checks.append(lambda request: method_matches(request.method))
     required_path = config.get("path")
-    if required_path and not matches_value_or_list(request.path, required_path):
-        return False
-    required_query = config.get("query")
+    if required_path:
+        path_matches = compile_str_matcher(required_path)
+        checks.append(lambda request: path_matches(request.path))
+    required_query = config.get("_query")
     if required_query:
-        query = request.query
-        for key in required_query:
-            value = required_query[key]
-            if not ((key in query) and matches_value_or_list(query[key], value)):
-                return False
+        checks.append(lambda request: query_matches(request.query, required_query))
     required_content = config.get("request")
-    if required_content and not content_matches(request.text, required_content):
-        return False
+    if required_content:
+        checks.append(lambda request: content_matches(request.text, required_content))
     required_state = config.get("require")
     if required_state:
-        if isinstance(required_state, dict):
-            for variable, required_value in required_state.items():
-                value = mock_state.get(variable, "")
-                if not matches_value_or_list(value, required_value):
-                    return False
-        else:
-            variable = config.get("variable", request.path.split("?")[0])
-            if not matches_value_or_list(mock_state.get(variable, ""), required_state):
+        checks.append(lambda request: state_matches(request, config, required_state))
+    if not checks:
+        return lambda request: True
+    elif len(checks) == 1:
+        return checks[0]
+    def match(request: http.Request) -> bool:
+        for check in checks:
+            if not check(request):
                 return False
-    return True
+        return True
+    return match
+
+def compile_status_matcher(config: dict) -> Callable[[http.Response], bool]:
+    """
+    Returns a function that returns whether the status code of a response
+    is matched by the handler `config`, performing only the checks that
+    `config` requires of the following:
+
+    - `status` (the HTTP status code)
+    - `error` (true iff the HTTP status >= 400)
+    """
+    required_status = config.get("status")
+    required_error_state = config.get("error")
+    if not isinstance(required_error_state, bool):
+        required_error_state = None
+    if required_status:
+        if required_error_state is None:
+            return lambda response: matches_value_or_list(response.status_code, required_status)
+        return lambda response: (
+            matches_value_or_list(response.status_code, required_status)
+            and required_error_state == (response.status_code >= 400)
+        )
+    if required_error_state is None:
+        return lambda response: True
+    return lambda response: required_error_state == (response.status_code >= 400)
 
 def is_subset(subset, superset) -> bool:
     """
@@ -150,7 +371,9 @@ def is_subset(subset, superset) -> bool:
     """
     try:
         if isinstance(subset, dict):
-            return all(key in superset and is_subset(subset[key], superset[key]) for key in subset)
+            if isinstance(superset, dict) and not (subset.keys() <= superset.keys()):
+                return False
+            return all(key in superset and is_subset(value, superset[key]) for key, value in subset.items())
         elif isinstance(subset, list):
             return all(any(is_subset(subitem, superitem) for superitem in superset) for subitem in subset)
         elif isinstance(subset, str):
@@ -161,10 +384,13 @@ def is_subset(subset, superset) -> bool:
                 return bool(allow_re.search(str(superset)))
             else:
                 return str(superset) == subset
+        elif isinstance(subset, re.Pattern):
+            return bool(subset.search(str(superset)))
         else:
             return subset == superset
     except Exception as error:
-        ctx.log.debug("is_subset incompatible types: {}: {} {}".format(error, subset, superset))
+        if debug_logging:
+            ctx.log.debug(f"is_subset incompatible types: {error}: {subset} {superset}")
         return False
 
 def content_matches(content_str: Optional[str], allow: Union[str,list,dict], content_object: Optional[Union[dict,list]] = None) -> bool:
@@ -179,14 +405,17 @@ def content_matches(content_str: Optional[str], allow: Union[str,list,dict], con
       which must be a superset `allow` (see `is_subset`)
     - a list of any of the above, which must all match
     """
-    if isinstance(allow, str) or isinstance(allow, dict):
+    if isinstance(allow, (str, dict, re.Pattern)):
         allow = [ allow ]
     for allowed in allow:
         try:
-            if isinstance(allowed, str):
+            if isinstance(allowed, (str, re.Pattern)):
                 if content_str is None:
                     content_str = content_as_str(content_object) or str(content_object)
-                if allowed.startswith("~"):
+                if isinstance(allowed, re.Pattern):
+                    if not allowed.search(content_str):
+                        return False
+                elif allowed.startswith("~"):
                     allow_re = compiled_re_for(allowed[1:])
                     if not allow_re.search(content_str):
                         return False
@@ -194,50 +423,94 @@ def content_matches(content_str: Optional[str], allow: Union[str,list,dict], con
                     return False
             elif isinstance(allowed, dict):
                 if content_object is None:
-                    content_object = content_as_object(content_str) or {}
+                    if content_str and JSON_START_RE.match(content_str):
+                        content_object = content_as_object(content_str) or {}
+                    else:
+                        content_object = {}
                 if not is_subset(allowed, content_object):
                     return False
             elif not content_matches(content_str, allowed, content_object):
                 return False
         except Exception as error:
-            ctx.log.info("Error: {}: matching {}".format(error, allowed))
+            ctx.log.info(f"Error: {error}: matching {allowed}")
             return False
     return True
 
-def response_matches_config(response: Optional[http.Response], config: dict) -> bool:
+def headers_match(required_headers: Union[str,list,dict], headers) -> bool:
     """
-    Returns whether `response` is matched by `config`. This checks the following:
+    Returns whether `headers` matches the `required_headers` criteria (see
+    `content_matches`).
 
-    - `status` (the HTTP status code)
-    - `error` (true iff the HTTP status >= 400)
-    - `content` (a string or a list of strings where _all_ must match)
+    `headers` may be any mapping, such as the mitmproxy `Headers` or a
+    `ChainMap` of them, which are matched directly (and thus with
+    case-insensitive names) by dictionary criteria. Only other criteria need
+    the headers converted to a dictionary.
 
-    For content matching, each string can either be a regular expression denoted
-    by a tilde prefix (`~`), otherwise a substring that must be found exactly.
+    `required_headers` may also be a tuple of header names and their plain
+    string or compiled regular expression values, as flattened from a
+    dictionary by `compile_handler`.
+    """
+    if isinstance(required_headers, tuple):
+        for name, allowed in required_headers:
+            value = headers.get(name)
+            if value is None:
+                return False
+            if isinstance(allowed, str):
+                if value != allowed:
+                    return False
+            elif not allowed.search(value):
+                return False
+        return True
+    if isinstance(required_headers, dict) or (isinstance(required_headers, list) and all(isinstance(allowed, dict) for allowed in required_headers)):
+        return content_matches(None, required_headers, headers)
+    return content_matches(None, required_headers, dict(headers))
+
+def response_content_matches_config(response: http.Response, config: dict) -> bool:
+    """
+    Returns whether the content of `response` is matched by `config`, i.e.,
+    `content` (a string or a list of strings where _all_ must match, see
+    `content_matches`).
     """
-    if not response:
-        return False
-    required_status = config.get("status")
-    if required_status and not matches_value_or_list(response.status_code, required_status):
-        return False
-    required_error_state = config.get("error")
-    if isinstance(required_error_state, bool) and required_error_state != (response.status_code >= 400):
-        return False
     required_content = config.get("content")
     if required_content and not content_matches(response.text, required_content):
         return False
     return True
 
+def flow_matches_config(flow: http.HTTPFlow, config: dict, is_request: bool) -> bool:
+    """
+    Returns whether `flow` is matched by `config` for the request event (if
+    `is_request`) or the response event.
+
+    For responses the status code is checked first and the content last,
+    since they are the cheapest and the most expensive checks, respectively.
+    The request and the status code are matched by the functions compiled
+    by `compile_request_matcher` and `compile_status_matcher`.
+    """
+    if is_request:
+        return config["_match_request"](flow.request)
+    return (
+        bool(flow.response)
+        and config["_match_status"](flow.response)
+        and config["_match_request"](flow.request)
+        and response_content_matches_config(flow.response, config)
+    )
+
+def is_file_reference(value) -> bool:
+    """
+    Returns whether `value` is a string referring to a JSON file, i.e., one
+    that `resolve_value` replaces with the contents of the file.
+    """
+    return isinstance(value, str) and value.startswith(".") and value.endswith((".json", ".js"))
+
 def resolve_value(value):
     """
     Resolves `value` into the final, expanded value, e.g., loads file contents
     referenced from value strings.
     """
-    if isinstance(value, str) and (value.startswith(".") and (value.endswith(".json") or value.endswith(".js"))):
+    if is_file_reference(value):
         try:
-            with open(value) as value_file:
-                value = json.load(value_file)
-        except:
+            value = load_json_file(value)
+        except Exception:
             pass
     return value
 
@@ -248,12 +521,20 @@ def merge_content(merge, content):
     merge = resolve_value(merge)
     if isinstance(merge, dict):
         if len(merge) == 1 and ("replace_with" in merge):
-            content = resolve_value(merge["replace_with"])
+            content = merge["replace_with"]
+            if is_file_reference(content):
+                content = resolve_value(content)
+            else:
+                # Copied so that later modifications don't change the configuration
+                content = copy.deepcopy(content)
         elif len(merge) == 1 and ("replace_in" in merge):
             content = replace_in_content(merge["replace_in"], content)
         elif isinstance(content, dict):
-            for key in merge:
-                content[key] = merge_content(merge[key], content.get(key))
+            for key, value in merge.items():
+                if isinstance(value, (dict, list)) or is_file_reference(value):
+                    content[key] = merge_content(value, content.get(key))
+                else:
+                    content[key] = value
         elif isinstance(content, list) and ("where" in merge):
             where = merge["where"]
             match_condition = not bool(merge.get("negated", False))
@@ -299,8 +580,11 @@ def merge_content(merge, content):
                     index += 1
         else:
             content = {}
-            for key in merge:
-                content[key] = merge_content(merge[key], None)
+            for key, value in merge.items():
+                if isinstance(value, (dict, list)) or is_file_reference(value):
+                    content[key] = merge_content(value, None)
+                else:
+                    content[key] = value
     elif isinstance(merge, list):
         merge = list(map(resolve_value, merge))
         if content is None:
@@ -323,8 +607,7 @@ def delete_content(delete, content):
     according to `is_subset`, and any matches are deleted from `content`.
     """
     if isinstance(delete, dict):
-        for key in delete:
-            value = delete[key]
+        for key, value in delete.items():
             if isinstance(value, dict):
                 if value:
                     content_value = content.get(key)
@@ -345,8 +628,7 @@ def delete_content(delete, content):
                     content.pop(key, None)
     elif isinstance(delete, list):
         if delete and isinstance(content, list):
-            for deletion in delete:
-                content = [ value for value in content if not is_subset(deletion, value) ]
+            content = [ value for value in content if not any(is_subset(deletion, value) for deletion in delete) ]
         else:
             content = []
     return content
@@ -365,47 +647,67 @@ def content_as_str(content) -> str:
         else:
             content = json.dumps(content)
     except Exception as error:
-        ctx.log.info("Error converting to text: {}: {}".format(error, content))
+        ctx.log.info(f"Error converting to text: {error}: {content}")
         content = ""
     return content
 
+def parse_json(text: Union[str,bytes]):
+    """
+    Returns the object parsed from the JSON string `text`, using `orjson` if
+    it is installed. Falls back to the standard `json` module for anything
+    `orjson` does not accept, such as `NaN`.
+    """
+    if orjson:
+        try:
+            return orjson.loads(text)
+        except ValueError:
+            pass
+    return json.loads(text)
+
 def content_as_object(content):
     """
     Returns `content` as an object, converting from JSON if necessary.
     """
     if isinstance(content, str) or content is None:
         try:
-            content = json.loads(content)
+            content = parse_json(content)
         except Exception as error:
-            ctx.log.info("Error loading JSON: {}: {}".format(error, content))
+            ctx.log.info(f"Error loading JSON: {error}: {content}")
             content = {}
     return content
 
 def replace_in_content(replace: Union[str,list,dict], content):
     """
     Performs replacement `replace` (dict update or regex sub) in `content`.
+    The values of `replace` are copied, since the configuration is shared
+    by all responses and later modifications may change the content.
     """
     if isinstance(replace, dict):
         content = content_as_object(content) or {}
+        replace = copy.deepcopy(replace)
         try:
             content.update(replace)
         except Exception:
             content = replace
     elif replace:
-        if isinstance(replace, str):
-            fields = replace[1:].split(replace[0])
-            if len(fields) == 2:
-                replace = fields
-            else:
-                return replace
-        sub_re, replacement = compiled_re_for(replace[0]), replace[1]
+        if isinstance(replace, tuple):
+            # Already compiled by `compile_modifications`
+            sub_re, replacement, _ = replace
+        else:
+            if isinstance(replace, str):
+                fields = replace[1:].split(replace[0])
+                if len(fields) == 2:
+                    replace = fields
+                else:
+                    return replace
+            sub_re, replacement = compiled_re_for(replace[0]), replace[1]
         try:
             content_is_str = isinstance(content, str)
             content = sub_re.sub(replacement, content_as_str(content))
             if not content_is_str:
                 content = content_as_object(content)
         except ValueError as error:
-            ctx.log.error("Invalid JSON: {}: after replace: {}".format(error, replace))
+            ctx.log.error(f"Invalid JSON: {error}: after replace: {replace}")
     return content
 
 def modify_content(modify: Union[str,list,dict], content):
@@ -424,10 +726,11 @@ def modify_content(modify: Union[str,list,dict], content):
             if replace:
                 if isinstance(replace, str):
                     try:
-                        with open(replace, "rb") as replace_file:
-                            text = replace_file.read().decode("utf-8")
+                        file_content = read_content_file(replace)
+                        if file_content:
+                            text = file_content[0].decode("utf-8")
                             try:
-                                replace = json.loads(text)
+                                replace = parse_json(text)
                             except ValueError:
                                 replace = text
                     except Exception:
@@ -438,47 +741,205 @@ def modify_content(modify: Union[str,list,dict], content):
                     content = replace_in_content(replace, content)
             if merge:
                 if isinstance(merge, str):
-                    with open(merge) as merge_file:
-                        merge = json.load(merge_file)
+                    merge = load_json_file(merge)
                 content = merge_content(merge, content_as_object(content))
         else:
             try:
-                if isinstance(modification, str):
-                    modification = modification[1:].split(modification[0])
-                sub_re, replacement = compiled_re_for(modification[0]), modification[1]
+                if isinstance(modification, tuple):
+                    # Already compiled by `compile_modifications`
+                    sub_re, replacement, _ = modification
+                else:
+                    if isinstance(modification, str):
+                        modification = modification[1:].split(modification[0])
+                    sub_re, replacement = compiled_re_for(modification[0]), modification[1]
                 content = sub_re.sub(replacement, content_as_str(content))
             except Exception as error:
-                ctx.log.info("Error modifying with {}: {}".format(modification, error))
+                ctx.log.info(f"Error modifying with {modification}: {error}")
     return content
 
-def encode_content(content: Union[str,list,dict]) -> Tuple[bytes, str]:
+def compile_modifications(modify):
+    """
+    Returns the `modify` configuration with its regular expression
+    substitutions, i.e., strings of the form `/regex/replacement` and arrays
+    of the form `[ "regex", "replacement" ]`, compiled into tuples by
+    `compile_substitution` (see `modify_content`). A single substitution is
+    returned as an array. The `replace` substitutions of modification
+    dictionaries, and the `content` and `query` modifications of a request
+    `modify` dictionary, are also compiled. Anything that can't be compiled
+    is left as is.
+    """
+    if isinstance(modify, str):
+        compiled = compile_substitution(modify)
+        return [ compiled ] if compiled else modify
+    elif isinstance(modify, list):
+        return [ compile_modification(modification) for modification in modify ]
+    return compile_modification(modify)
+
+def compile_modification(modification):
+    """
+    Returns the single `modification` compiled as per `compile_modifications`.
+    """
+    if isinstance(modification, dict):
+        modification = dict(modification)
+        for key in ("content", "query"):
+            if isinstance(modification.get(key), (str, list)):
+                modification[key] = compile_modifications(modification[key])
+        if isinstance(modification.get("replace"), list):
+            modification["replace"] = compile_substitution(modification["replace"]) or modification["replace"]
+        if isinstance(modification.get("delete"), (dict, list)):
+            modification["delete"] = compile_deletion(modification["delete"])
+        return modification
+    return compile_substitution(modification) or modification
+
+def compile_deletion(delete):
+    """
+    Returns the `delete` modification with the regular expressions in the
+    elements of its lists compiled by `compile_patterns`, since those are
+    matched with `is_subset` (see `delete_content`). Other values are
+    compared literally and are left as is.
+    """
+    if isinstance(delete, dict):
+        return { key: compile_deletion(value) if isinstance(value, (dict, list)) else value for key, value in delete.items() }
+    elif isinstance(delete, list):
+        return [ compile_patterns(deletion, is_content=True) for deletion in delete ]
+    return delete
+
+def compile_substitution(modification) -> Optional[tuple]:
+    """
+    Returns the regular expression substitution `modification` as a tuple of
+    the compiled regular expression, the replacement, and the same for bytes
+    (or `None`), or `None` if it is not a valid substitution.
+
+    The bytes substitution is only compiled if the regular expression
+    consists of literal ASCII characters, so that it matches the same in
+    encoded content as in text for charsets compatible with ASCII.
+    """
+    try:
+        if isinstance(modification, str):
+            modification = modification[1:].split(modification[0])
+        if isinstance(modification, list) and len(modification) >= 2:
+            re_str, replacement = modification[0], modification[1]
+            if isinstance(re_str, str) and isinstance(replacement, str):
+                bytes_substitution = None
+                if re_str and LITERAL_ASCII_RE.match(re_str) and replacement.isascii():
+                    bytes_substitution = (re.compile(re_str.encode("ascii")), replacement.encode("ascii"))
+                return (compiled_re_for(re_str), replacement, bytes_substitution)
+    except (IndexError, re.error):
+        pass
+    return None
+
+def modify_encoded_content(modify, message) -> bool:
+    """
+    Modifies the content of `message` (a request or response) according to
+    `modify` in its encoded form, without decoding it, if all modifications
+    are substitutions with a bytes form (see `compile_substitution`) and the
+    charset of `message` is compatible with ASCII. Returns whether the
+    content was modified, otherwise it must be modified as text. The content
+    is left unchanged if any substitution fails, e.g., due to an invalid
+    group reference, so that the text modification reports the error.
+    """
+    content = message.content
+    if content is None or not isinstance(modify, list):
+        return False
+    if not all(isinstance(modification, tuple) and modification[2] for modification in modify):
+        return False
+    if not has_ascii_compatible_charset(message):
+        return False
+    try:
+        for _, _, (sub_re, replacement) in modify:
+            content = sub_re.sub(replacement, content)
+    except Exception:
+        return False
+    message.content = content
+    return True
+
+def has_ascii_compatible_charset(message) -> bool:
+    """
+    Returns whether the content of `message` (a request or response) is known
+    to be in a charset compatible with ASCII, i.e., one where ASCII characters
+    are encoded as themselves and are not part of other characters. JSON
+    content without a declared charset is UTF-8.
+    """
+    content_type = message.headers.get("Content-Type", "").lower()
+    _, _, charset = content_type.partition("charset=")
+    charset = charset.split(";")[0].strip().strip("\"'")
+    if charset:
+        return charset in ASCII_COMPATIBLE_CHARSETS
+    return "json" in content_type
+
+def is_possible_filename(string: str) -> bool:
+    """
+    Returns whether `string` could plausibly be a file name, so that raw
+    content strings can be told apart without a failing filesystem access.
+    A file name must be short, may not contain a newline or start with a
+    character that begins HTML or JSON content, and must contain a dot or a
+    slash.
+    """
+    return (
+        len(string) <= 260 and not "\n" in string
+        and not string.startswith(("<", "{", "["))
+        and ("/" in string or "." in string or os.sep in string)
+    )
+
+def read_content_file(filename: str) -> Optional[Tuple[bytes, str]]:
+    """
+    Returns a tuple of the contents of the file `filename` and its type
+    inferred from the file's extension, or `None` if the file can't be read.
+
+    The contents are cached in memory and only read again from disk if the
+    modification time or the size of the file changes.
+    """
+    try:
+        file_stat = os.stat(filename)
+        modified_at = (file_stat.st_mtime_ns, file_stat.st_size)
+        cached = file_cache.get(filename)
+        if cached and cached[0] == modified_at:
+            return cached[1], cached[2]
+        with open(filename, "rb") as content_file:
+            data = content_file.read()
+    except (OSError, ValueError):
+        return None
+    extension = os.path.splitext(filename)[1].lower()
+    content_type = EXTENSION_CONTENT_TYPES.get(extension, "application/json")
+    file_cache[filename] = (modified_at, data, content_type)
+    return data, content_type
+
+def load_json_file(filename: str):
+    """
+    Returns the object parsed from the JSON file `filename`, which is read
+    through the cache of `read_content_file`. Raises `OSError` if the file
+    can't be read, or `ValueError` if it is not valid JSON.
+    """
+    file_content = read_content_file(filename)
+    if file_content is None:
+        raise OSError(f"Can't read file {filename}")
+    return parse_json(file_content[0])
+
+def encode_content(content: Union[str,list,dict,tuple]) -> Tuple[bytes, str]:
     """
     Return a tuple of `content` encoded into bytes, and a guess of its type.
 
     `content` may be any of the following:
     - A file name string, in which case the content is loaded from the file and
-      type inferred from the file's extension (json, js, html, xml, txt, md).
+      type inferred from the file's extension (json, js, html, htm, xhtml,
+      xml, txt, md).
     - A raw string, in which case it is encoded according as UTF-8, and the type
       is inferred to be HTML if it starts with a `<`, otherwise JSON.
     - A list or dictionary that can be dumped as JSON, in which case
       it is processed as per `merge_content` and converted to UTF-8 JSON.
+    - A tuple of content already encoded by this function.
     """
+    if isinstance(content, tuple):
+        # Already encoded by `precompute_responses`
+        return content
     content_type = "application/json"
     if isinstance(content, str):
-        try:
-            with open(content, "rb") as content_file:
-                if content.endswith("html"):
-                    content_type = "text/html"
-                elif content.endswith(".xml"):
-                    content_type = "text/xml"
-                elif content.endswith(".txt") or content.endswith(".md"):
-                    content_type = "text/plain"
-                elif content.endswith(".js"):
-                    content_type = "application/javascript"
-                return content_file.read(), content_type
-        except FileNotFoundError:
-            if content.startswith("<"):
-                content_type = "text/html"
+        if is_possible_filename(content):
+            file_content = read_content_file(content)
+            if file_content is not None:
+                return file_content
+        if content.startswith("<"):
+            content_type = "text/html"
     else:
         try:
             processed_content = content
@@ -492,7 +953,7 @@ def encode_content(content: Union[str,list,dict]) -> Tuple[bytes, str]:
             pass
     return content_as_str(content).encode("utf-8"), content_type + "; charset=utf-8"
 
-def make_response(response: Union[str,dict], status, content, headers) -> http.Response:
+def make_response(response: Union[str,dict,tuple], status, content, headers) -> http.Response:
     """
     Return a new `Response` object constructed from the configuration
     `response`, with the status code, content and headers defaulting to the
@@ -505,87 +966,476 @@ def make_response(response: Union[str,dict], status, content, headers) -> http.R
      - `charset`: The charset part of the Content-Type header
      - `headers`: A dictionary of HTTP headers
 
+    `response` may also be a tuple of the status code, content and headers
+    already constructed by `response_parts`.
+
     See also: `encode_content`
     """
+    if not isinstance(response, tuple):
+        response = response_parts(response, status, content, headers, default_charset)
+    status, content, headers = response
+    if debug_logging:
+        ctx.log.debug(f"Response {status}: headers={headers} content={content}")
+    try:
+        return http.Response.make(status, content, headers)
+    except (NameError, AttributeError):
+        # Backwards compatibility with mitmproxy < 7.0.0
+        return http.HTTPResponse.make(status, content, headers)
+
+def response_parts(response: Union[str,dict], status, content, headers, default_charset: str) -> Tuple[int, bytes, dict]:
+    """
+    Returns a tuple of the status code, content and headers for the response
+    configuration `response` (see `make_response`), with `default_charset`
+    used unless `response` specifies the charset.
+    """
     if isinstance(response, str):
         response = { "content": response }
     content, content_type = encode_content(response.get("content", content))
     content_type = response.get("type", headers.get("Content-Type", content_type))
-    charset = response.get("charset", mock_config.get("charset", "utf-8"))
+    charset = response.get("charset", default_charset)
     if charset and not ((";" in content_type) or ("image" in content_type)):
-        content_type = "{}; charset={}".format(content_type, charset)
-    headers = {**headers, **{ "Content-Type": content_type }}
-    merge_headers = response.get("headers", {})
-    if isinstance(merge_headers, dict):
+        content_type = f"{content_type}; charset={charset}"
+    headers = dict(headers)
+    headers["Content-Type"] = content_type
+    merge_headers = response.get("headers")
+    if merge_headers and isinstance(merge_headers, dict):
         headers.update(merge_headers)
-    status = response.get("status", status)
-    ctx.log.debug("Response {}: headers={} content={}".format(status, headers, content))
-    try:
-        return http.Response.make(int(status), content, headers)
-    except NameError:
-        # Backwards compatibility with mitmproxy < 7.0.0
-        return http.HTTPResponse.make(status, content, headers)
+    return int(response.get("status", status)), content, headers
 
-
-def extract_regex_paths(config: OrderedDict) -> OrderedDict:
+def extract_regex_paths(config: dict) -> dict:
     """
-    Returns an `OrderedDict` of compiled regex paths from `config`.
+    Returns a dictionary of compiled regex paths from `config`.
 
     A regex path in `config` is a string with a tilde prefix (`~`),
     where the rest of the string is a regular expression. Those
     paths are taken in order, compiled, an added to the resulting
-    ordered dictionary in the same order.
+    dictionary in the same order (dictionaries preserve insertion order).
     """
-    re_paths = OrderedDict()
+    re_paths = {}
     if config:
         for path, handler in config.items():
             if not path.startswith("~"):
                 continue
             try:
                 path_re = compiled_re_for(path[1:])
-                re_paths[path_re] = json.loads(json.dumps(handler))
+                re_paths[path_re] = handler
             except Exception as error:
-                ctx.log.error("Error: regex path {}: {}".format(path, error))
+                ctx.log.error(f"Error: regex path {path}: {error}")
     return re_paths
 
+def compile_path_union(re_paths: dict) -> Optional[tuple]:
+    """
+    Returns a tuple of a single compiled regular expression combining the
+    regex paths `re_paths`, and a dictionary from its group names to the
+    handlers, or `None` if the paths cannot be combined.
+
+    Each path is wrapped in a named lookahead group, so that matching the
+    combined expression at the start of a string finds the first path (in
+    order) that `search` would find anywhere in the string. The paths are
+    not combined if any of them can't be (see `compiled_re_union`).
+    """
+    if len(re_paths) < 2:
+        return None
+    re_strs = [ path_re.pattern for path_re in re_paths ]
+    if any(UNCOMBINABLE_RE_SYNTAX_RE.search(re_str) for re_str in re_strs):
+        return None
+    try:
+        # The newline terminates any verbose mode comment in a pattern
+        union_re = compiled_re_for("|".join(f"(?P<r{index}>(?=[\\s\\S]*?(?:{re_str}\n)))" for index, re_str in enumerate(re_strs)))
+    except re.error:
+        return None
+    return (union_re, { f"r{index}": handler for index, handler in enumerate(re_paths.values()) })
+
+def compile_scheme_matcher(allow):
+    """
+    Returns the scheme matcher `allow` as a bit mask of `SCHEME_BITS` if it
+    consists only of the plain schemes listed there, otherwise returns it as
+    compiled by `compile_value_list`.
+    """
+    schemes = [ allow ] if isinstance(allow, str) else allow
+    if isinstance(schemes, list) and schemes and all(isinstance(scheme, str) and scheme in SCHEME_BITS for scheme in schemes):
+        mask = 0
+        for scheme in schemes:
+            mask |= SCHEME_BITS[scheme]
+        return mask
+    return compile_patterns(compile_value_list(allow))
+
+def compile_query(required_query: Optional[dict]) -> tuple:
+    """
+    Returns the query matcher `required_query` as a tuple of the key and
+    the function matching its value (see `compile_str_matcher`) for each key.
+    """
+    compiled = []
+    if not isinstance(required_query, dict):
+        return ()
+    for key, allow in required_query.items():
+        compiled.append((key, compile_str_matcher(compile_patterns(compile_value_list(allow)))))
+    return tuple(compiled)
+
+def compile_str_matcher(allow) -> Callable[[str], bool]:
+    """
+    Returns a function that returns whether a string value matches `allow`,
+    as per `matches_value_or_list`, specialized for sets of plain values and
+    regular expressions.
+    """
+    if isinstance(allow, frozenset):
+        return allow.__contains__
+    elif isinstance(allow, re.Pattern):
+        return lambda value: bool(allow.search(value)) or value == f"~{allow.pattern}"
+    return lambda value: matches_value_or_list(value, allow)
+
+def compile_handlers(handlers, charset: str = "utf-8", is_response: bool = False) -> None:
+    """
+    Precompiles the matchers of the path handlers in `handlers` (either
+    the `request` or `response` section of the configuration, or the
+    regex paths extracted from it) in place. The compiled matchers are
+    stored in the handler dictionaries under keys prefixed with `_`.
+    The `charset` is the default charset of the configuration, and
+    `is_response` tells whether the handlers are response handlers.
+
+    Regex paths in the configuration sections are skipped, since their
+    handlers are shared with (and compiled as) the extracted regex paths.
+    """
+    if not handlers:
+        return
+    for path, handler in handlers.items():
+        if isinstance(path, str) and path.startswith("~"):
+            continue
+        for handler_config in (handler if isinstance(handler, list) else [ handler ]):
+            if isinstance(handler_config, dict):
+                compile_handler(handler_config, charset, is_response)
+
+def compile_handler(config: dict, charset: str = "utf-8", is_response: bool = False) -> None:
+    """
+    Precompiles the matchers of the handler `config` in place.
+    """
+    if "host" in config:
+        config["_host"] = compile_host_matcher(config["host"])
+    if "scheme" in config:
+        config["scheme"] = compile_scheme_matcher(config["scheme"])
+    for key in ("method", "path", "status", "require"):
+        if key in config:
+            config[key] = compile_patterns(compile_value_list(config[key]))
+    for key in ("request", "content", "headers"):
+        if key in config:
+            config[key] = order_content_matchers(compile_patterns(config[key], is_content=True))
+    required_headers = config.get("headers")
+    if isinstance(required_headers, dict) and all(
+        isinstance(value, re.Pattern) or (isinstance(value, str) and not value.startswith("~"))
+        for value in required_headers.values()
+    ):
+        config["headers"] = tuple(required_headers.items())
+    if "query" in config:
+        config["_query"] = compile_query(config["query"])
+    required_state = config.get("require")
+    if isinstance(required_state, dict):
+        config["require"] = { name: compile_patterns(compile_value_list(value)) for name, value in required_state.items() }
+    compile_actions(config, charset, is_response)
+
+def compile_actions(config: dict, charset: str = "utf-8", is_response: bool = False) -> None:
+    """
+    Precompiles the actions of the handler `config` and its stateful
+    sub-handlers in place. If `is_response`, the `modify` action is
+    normalized to an array. A `log` of `true` is replaced by the default
+    message.
+    """
+    precompute_responses(config, charset)
+    if config.get("log") is True:
+        config["log"] = "Log"
+    if "modify" in config:
+        modify = compile_modifications(config["modify"])
+        if is_response:
+            if not modify:
+                modify = []
+            elif not isinstance(modify, list):
+                modify = [ modify ]
+        config["modify"] = modify
+    for sub_handler in stateful_sub_handlers(config):
+        compile_actions(sub_handler, charset, is_response)
+    random_configs = config.get("random")
+    if isinstance(random_configs, list) and random_configs:
+        # The weights are kept with the handlers they belong to, since either
+        # may be merged from the default handler
+        cum_weights = None
+        weights = config.get("random-weights")
+        if weights is not None:
+            if (
+                isinstance(weights, list) and len(weights) == len(random_configs)
+                and all(type(weight) in (int, float) and weight >= 0 for weight in weights)
+                and sum(weights) > 0
+            ):
+                cum_weights = tuple(itertools.accumulate(weights))
+            else:
+                ctx.log.error(f"Error: invalid random-weights: {weights}")
+        config["random"] = (tuple(random_configs), cum_weights)
+    count_config = config.get("count")
+    if isinstance(count_config, dict) and count_config:
+        config["count"] = (count_config.get("id"), compile_count_resolver(count_config))
+    state_config = config.get("state")
+    if isinstance(state_config, dict) and state_config:
+        config["state"] = compile_state_table(state_config)
+
+def stateful_sub_handlers(config: dict) -> list:
+    """
+    Returns the handlers nested inside the stateful handlers (`once`, `count`,
+    `cycle`, `random`, and `state`) of the handler `config`.
+    """
+    sub_handlers = []
+    once_config = config.get("once")
+    if isinstance(once_config, dict):
+        sub_handlers.append(once_config)
+    for key in ("count", "state"):
+        nested = config.get(key)
+        if isinstance(nested, dict):
+            sub_handlers.extend(value for value in nested.values() if isinstance(value, dict))
+    for key in ("cycle", "random"):
+        nested = config.get(key)
+        if isinstance(nested, list):
+            sub_handlers.extend(value for value in nested if isinstance(value, dict))
+    return sub_handlers
+
+def refers_to_files(value) -> bool:
+    """
+    Returns whether `value` contains any file references (see
+    `is_file_reference`).
+    """
+    if isinstance(value, str):
+        return is_file_reference(value)
+    elif isinstance(value, dict):
+        return any(refers_to_files(element) for element in value.values())
+    elif isinstance(value, list):
+        return any(refers_to_files(element) for element in value)
+    return False
+
+def precompute_responses(config: dict, charset: str = "utf-8") -> None:
+    """
+    Encodes the JSON object and raw string content of the `respond` and
+    `replace` responses of the handler `config` in place, so that it is not
+    encoded again for every response. Content referring to files is left as
+    is, since the files may change. A `replace` dictionary with the key
+    `response` is replaced by its value.
+
+    A `respond` response that does not depend on any files is replaced by
+    the tuple of its status code, content and headers (see `make_response`),
+    using `charset` as the default charset.
+
+    See also: `encode_content`
+    """
+    replace = config.get("replace")
+    if isinstance(replace, dict):
+        config["replace"] = replace.get("response", replace)
+    for key in ("respond", "replace"):
+        response = config.get(key)
+        if isinstance(response, dict):
+            content = response.get("content")
+            if isinstance(content, (dict, list)) and not refers_to_files(content):
+                response["content"] = encode_content(content)
+            elif isinstance(content, str) and not is_possible_filename(content):
+                response["content"] = encode_content(content)
+    response = config.get("respond")
+    if isinstance(response, str):
+        response = { "content": response }
+    if isinstance(response, dict):
+        content = response.get("content", "")
+        if isinstance(content, tuple) or (isinstance(content, str) and not is_possible_filename(content)):
+            try:
+                config["respond"] = response_parts(response, 200, "", {}, charset)
+            except (TypeError, ValueError):
+                pass
+
+def merge_default_handler(handlers, default_handler) -> None:
+    """
+    Merges the default handler `default_handler` (i.e., `*`) into each of the
+    other path handlers in `handlers` in place, so that the merged handlers
+    need not be constructed for every request.
+
+    If the default handler is an array, each path handler dictionary becomes
+    an array of the default handlers with the path handler merged on top, and
+    any path handler array is left as is.
+    """
+    if not handlers or not default_handler:
+        return
+    for path, handler in handlers.items():
+        if path == "*":
+            continue
+        if isinstance(handler, list):
+            if isinstance(default_handler, dict):
+                handlers[path] = [ {**default_handler, **handler_config} for handler_config in handler ]
+        elif isinstance(handler, dict):
+            if isinstance(default_handler, list):
+                handlers[path] = [ {**handler_config, **handler} for handler_config in default_handler ]
+            else:
+                handlers[path] = {**default_handler, **handler}
+
+def is_static_handler(config: dict) -> bool:
+    """
+    Returns whether the handler `config` matches requests based only on their
+    method, scheme, host and full path, and has no stateful handlers, so that
+    the result of matching it can be cached.
+    """
+    return not any(key in config for key in DYNAMIC_HANDLER_KEYS)
+
+def normalize_handlers(handlers, remove_missing: bool = True) -> None:
+    """
+    Replaces each path handler in `handlers` with a tuple of its handler
+    dictionaries in place, so that a single handler and an array of handlers
+    are matched the same way. Paths without a handler are removed if
+    `remove_missing`.
+
+    Each handler dictionary is marked with whether it is static (see
+    `is_static_handler`), and whether all handlers of its path are static.
+    """
+    if not handlers:
+        return
+    for path, handler in list(handlers.items()):
+        if handler is None and remove_missing:
+            del handlers[path]
+            continue
+        handler_configs = handler if isinstance(handler, list) else [ handler ]
+        handlers[path] = tuple(config for config in handler_configs if isinstance(config, dict))
+        for config in handlers[path]:
+            config["_static"] = is_static_handler(config)
+        is_static_path = all(config["_static"] for config in handlers[path])
+        for config in handlers[path]:
+            config["_static_path"] = is_static_path
+
+def compile_request_matchers(handlers, host_matcher: Optional[tuple], required_scheme) -> None:
+    """
+    Compiles the request matcher (see `compile_request_matcher`) of each
+    handler in the normalized path handlers `handlers` in place, with the
+    global `host_matcher` and `required_scheme` as defaults. The status
+    matcher (see `compile_status_matcher`) is compiled likewise.
+    """
+    if not handlers:
+        return
+    for handler in handlers.values():
+        for config in handler:
+            config["_match_request"] = compile_request_matcher(config, host_matcher, required_scheme)
+            config["_match_status"] = compile_status_matcher(config)
+
+def intern_keys(value):
+    """
+    Returns `value` with the keys of all dictionaries in it interned by
+    `sys.intern`, so that the keys of the configuration are found by
+    identity when looked up with the (interned) string literals of this
+    script.
+    """
+    if isinstance(value, dict):
+        return { sys.intern(key): intern_keys(element) for key, element in value.items() }
+    elif isinstance(value, list):
+        return [ intern_keys(element) for element in value ]
+    return value
+
 def load_config_file(mock_filename: str) -> None:
     """
     Loads the configuration file `mock_filename`, replacing the global config.
     """
     global mock_config, re_request, re_response, mock_state
+    global re_request_union, re_response_union
     global hit_count, cycle_index, config_modified_at
-    ctx.log.info("Loading mock configuration {}".format(mock_filename))
+    global default_host_matcher, default_scheme, default_response_modify, query_paths
+    global default_save, default_charset, configured_events
+    ctx.log.info(f"Loading mock configuration {mock_filename}")
     try:
         with open(mock_filename) as mock_config_file:
-            # OrderedDict hack to preserve path regex order
-            config_modified_at = os.path.getmtime(mock_filename)
-            ordered_config = json.load(mock_config_file, object_pairs_hook=OrderedDict)
-            request_re_paths = extract_regex_paths(ordered_config.get("request"))
-            response_re_paths = extract_regex_paths(ordered_config.get("response"))
-            mock_config = json.loads(json.dumps(ordered_config))
-            re_request, re_response = request_re_paths, response_re_paths
+            config_modified_at = os.stat(mock_filename).st_mtime_ns
+            config = intern_keys(parse_json(mock_config_file.read()))
+            request_re_paths = extract_regex_paths(config.get("request"))
+            response_re_paths = extract_regex_paths(config.get("response"))
+            for handlers, is_response in ((config.get("request"), False), (config.get("response"), True), (request_re_paths, False), (response_re_paths, True)):
+                compile_handlers(handlers, config.get("charset", "utf-8"), is_response)
+            for event, re_paths in (("request", request_re_paths), ("response", response_re_paths)):
+                default_handler = config.get(event, {}).get("*")
+                merge_default_handler(config.get(event), default_handler)
+                merge_default_handler(re_paths, default_handler)
+            default_modify = config.get("response", {}).get("*", {})
+            default_modify = default_modify.get("modify") if isinstance(default_modify, dict) else None
+            for handlers in (config.get("request"), config.get("response")):
+                normalize_handlers(handlers)
+            for re_paths in (request_re_paths, response_re_paths):
+                normalize_handlers(re_paths, remove_missing=False)
+            request_union, response_union = compile_path_union(request_re_paths), compile_path_union(response_re_paths)
+            host_matcher, scheme = compile_host_matcher(config.get("host")), compile_scheme_matcher(config.get("scheme"))
+            for handlers in (config.get("request"), config.get("response"), request_re_paths, response_re_paths):
+                compile_request_matchers(handlers, host_matcher, scheme)
+            mock_config = config
+            re_request, re_response = list(request_re_paths.items()), list(response_re_paths.items())
+            re_request_union, re_response_union = request_union, response_union
+            default_host_matcher, default_scheme = host_matcher, scheme
+            default_response_modify = default_modify or None
+            default_save, default_charset = config.get("save"), config.get("charset", "utf-8")
+            query_paths = { event: any("?" in path for path in config.get(event, {})) for event in ("request", "response") }
+            configured_events = frozenset(event for event in ("request", "response") if config.get(event))
+            resolve_cache.clear()
             hit_count.clear()
             cycle_index.clear()
             mock_state.clear()
+            file_cache.clear()
     except Exception as error:
-        ctx.log.error("Error: {}: {}".format(mock_filename, error))
+        ctx.log.error(f"Error: {mock_filename}: {error}")
     if not mock_config:
         ctx.log.error("No configuration: use --set config.json")
 
 def reload_config_if_updated(mock_filename: Optional[str] = None) -> None:
     """
     Reloads the configuration file `mock_filename` if it has been modified.
+    If the file is watched (see `watch_config_file`), the modification time
+    is only checked after the watcher has seen a change, otherwise it is
+    checked at most once per `RELOAD_CHECK_INTERVAL` seconds.
     """
+    global config_checked_at, config_changed
+    if config_watcher is not None:
+        if not config_changed:
+            return
+        config_changed = False
+    else:
+        checked_at = time.monotonic()
+        if checked_at - config_checked_at < RELOAD_CHECK_INTERVAL:
+            return
+        config_checked_at = checked_at
     try:
         if not mock_filename:
             mock_filename = str(ctx.options.mock)
-        timestamp = os.path.getmtime(mock_filename)
+        timestamp = os.stat(mock_filename).st_mtime_ns
         if timestamp != config_modified_at:
             load_config_file(mock_filename)
     except Exception as error:
-        ctx.log.error("Error: {}: {}".format(mock_filename, error))
+        ctx.log.error(f"Error: {mock_filename}: {error}")
+
+def watch_config_file(mock_filename: str) -> None:
+    """
+    Starts watching the configuration file `mock_filename` for changes with
+    `watchdog`, if it is installed, replacing any previous watcher. The
+    watcher thread only marks the file as changed, and the configuration is
+    reloaded on the next request (see `reload_config_if_updated`). If the
+    file can't be watched, its modification time is polled instead.
+    """
+    global config_watcher, config_changed
+    if config_watcher is not None:
+        config_watcher.stop()
+        config_watcher.join()
+        config_watcher = None
+    if Observer is None:
+        return
+    path = os.path.abspath(mock_filename)
+    def mark_changed(event) -> None:
+        global config_changed
+        if event.event_type not in ("modified", "created", "moved", "deleted", "closed"):
+            return
+        for event_path in (event.src_path, getattr(event, "dest_path", None)):
+            if event_path and os.path.abspath(os.fsdecode(event_path)) == path:
+                config_changed = True
+    try:
+        handler = FileSystemEventHandler()
+        handler.on_any_event = mark_changed
+        watcher = Observer()
+        watcher.schedule(handler, os.path.dirname(path))
+        watcher.start()
+        config_watcher, config_changed = watcher, False
+    except Exception as error:
+        ctx.log.info(f"Not watching {mock_filename}: {error}")
 
-def count_based_config(path: str, count_config: dict) -> dict:
+def count_based_config(path: str, count_config: Union[dict,tuple]) -> dict:
     """
     Returns `count_config` reduced to the merged configuration for this
     iteration based on the number of times `path` has been hit.
@@ -599,22 +1449,67 @@ def count_based_config(path: str, count_config: dict) -> dict:
 
     Note that the keys of `config["count"]` are strings, even for the numeric
     counts, since the data is loaded from JSON.
+
+    `count_config` may also be a tuple of the count id and the function
+    returned by `compile_count_resolver`, as precompiled at load time.
     """
     global hit_count
     result = {}
     if count_config:
-        count_id = count_config.get("id", path)
-        count = hit_count.get(count_id, 0) + 1
-        hit_count[count_id] = count
-        result.update(count_config.get("*", {}))
-        result.update(count_config.get("even" if (count % 2) == 0 else "odd", {}))
-        specific_config = count_config.get(str(count), count_config.get(count))
-        if specific_config is None:
-            specific_config = count_config.get("~", {})
-        result.update(specific_config or {})
+        if isinstance(count_config, tuple):
+            count_id, resolve_count = count_config
+            if count_id is None:
+                count_id = path
+        else:
+            count_id = count_config.get("id", path)
+            resolve_count = compile_count_resolver(count_config)
+        count = next(hit_count[count_id])
+        result = resolve_count(count)
     return result
 
-def state_based_config(variable: str, state_config: dict) -> dict:
+def compile_count_resolver(count_config: dict):
+    """
+    Returns a function that maps a hit count to the merged configuration of
+    `count_config` for that count (see `count_based_config`). The function is
+    specialized according to which keys are present, and the merged
+    configurations are computed in advance, with the exact counts keyed by
+    integer.
+    """
+    every = count_config.get("*") or {}
+    odd = {**every, **(count_config.get("odd") or {})}
+    even = {**every, **(count_config.get("even") or {})}
+    otherwise = count_config.get("~") or {}
+    exact = {}
+    for key, value in count_config.items():
+        if key.isdecimal() and str(int(key)) == key and value is not None:
+            count = int(key)
+            exact[count] = {**(even if (count % 2) == 0 else odd), **(value if isinstance(value, dict) else {})}
+    odd, even = {**odd, **otherwise}, {**even, **otherwise}
+    if not exact:
+        if odd == even:
+            return lambda count: odd
+        return lambda count: even if (count % 2) == 0 else odd
+    def resolve_count(count: int) -> dict:
+        specific_config = exact.get(count)
+        if specific_config is None:
+            return even if (count % 2) == 0 else odd
+        return specific_config
+    return resolve_count
+
+def compile_state_table(state_config: dict) -> tuple:
+    """
+    Returns a tuple of the variable name (or `None`), a dictionary from each
+    state value to the configuration merged on top of `*`, and the merged
+    configuration for `~`, for use by `state_based_config`.
+    """
+    every = state_config.get("*") or {}
+    table = {}
+    for key, value in state_config.items():
+        table[key] = {**every, **value} if isinstance(value, dict) else every
+    otherwise = {**every, **(state_config.get("~") or {})}
+    return (state_config.get("variable"), table, otherwise)
+
+def state_based_config(variable: str, state_config: Union[dict,tuple]) -> dict:
     """
     Returns `state_config` reduced to the merged configuration for this value
     of `variable` in the global `mock_state`.
@@ -622,8 +1517,14 @@ def state_based_config(variable: str, state_config: dict) -> dict:
     - `*`: applied to every state
     - the exact value of `variable`
     - `~` applied in case the exact value is not found
+
+    `state_config` may also be the tuple returned by `compile_state_table`,
+    as precompiled at load time.
     """
     global mock_state
+    if isinstance(state_config, tuple):
+        _, table, otherwise = state_config
+        return table.get(mock_state.get(variable, ""), otherwise)
     result = {}
     result.update(state_config.get("*", {}))
     value = mock_state.get(variable, "")
@@ -642,7 +1543,8 @@ def resolve_config_state(path: str, config: dict, is_copy: bool = False) -> dict
     - `once` – handler executed only once, shares the count with `count`
     - `count` – visit-count based handler
     - `cycle` – array of handlers, chosen in sequence with wrap-around
-    - `random` – an array of handlers, a random one is chosen every time
+    - `random` – an array of handlers, a random one is chosen every time,
+      optionally weighted by the array `random-weights`
     - `state` – a dictionary with the key `variable` for a variable name,
       and different handlers keyed by values of that variable
     """
@@ -686,106 +1588,225 @@ def resolve_config_state(path: str, config: dict, is_copy: bool = False) -> dict
         if not is_copy:
             config, is_copy = {**config}, True
         random_configs = config.pop("random")
+        weights = None
+        if isinstance(random_configs, tuple):
+            # Compiled by `compile_actions`
+            random_configs, weights = random_configs
         if random_configs:
-            config.update(random.choice(random_configs))
+            if weights:
+                config.update(random_generator.choices(random_configs, cum_weights=weights)[0])
+            else:
+                config.update(random_generator.choice(random_configs))
             return resolve_config_state(path, config, is_copy)
     if "state" in config:
         if not is_copy:
             config, is_copy = {**config}, True
         state_config = config.pop("state")
         if state_config:
-            variable = state_config.get("variable", config.get("variable", path))
+            if isinstance(state_config, tuple):
+                variable = state_config[0]
+                if variable is None:
+                    variable = config.get("variable", path)
+            else:
+                variable = state_config.get("variable", config.get("variable", path))
             config.update(state_based_config(variable, state_config))
             return resolve_config_state(path, config, is_copy)
     return config
 
+def request_path(flow: http.HTTPFlow) -> str:
+    """
+    Returns the path of the request in `flow` without the query. The result
+    is cached in the flow metadata, so the response reuses the path of the
+    request unless the request path has since been modified.
+    """
+    full_path = flow.request.path
+    cached = flow.metadata.get("mock_path")
+    if cached and cached[0] == full_path:
+        return cached[1]
+    query_start = full_path.find("?")
+    path = full_path if query_start < 0 else full_path[:query_start]
+    flow.metadata["mock_path"] = (full_path, path)
+    return path
+
+def match_config(flow: http.HTTPFlow, event: str, path: str) -> Tuple[Optional[dict], bool]:
+    """
+    Returns the handler configuration for the event (`request` or `response`)
+    that matches `flow`, or `None` if no configuration item matches. Also
+    returns whether the result depends only on the request method, scheme,
+    host and full path, i.e., whether it may be cached (see `is_static_handler`).
+    """
+    is_request = (event == "request")
+    handlers = mock_config.get(event, {})
+    path_handler = handlers.get(flow.request.path) if query_paths.get(event) else None
+    if path_handler is None:
+        path_handler = handlers.get(path)
+    if path_handler is None:
+        # Match the regexes if there is no direct match
+        re_union = (re_request_union if is_request else re_response_union)
+        if re_union:
+            union_re, union_handlers = re_union
+            match = union_re.match(flow.request.path)
+            if match:
+                path_handler = union_handlers[match.lastgroup]
+        else:
+            re_handlers = (re_request if is_request else re_response)
+            for path_re, re_handler in re_handlers:
+                if path_re.search(flow.request.path):
+                    path_handler = re_handler
+                    break
+        if path_handler is None:
+            return None, True
+    is_static = path_handler[0]["_static_path"] if path_handler else True
+    for handler_config in path_handler:
+        if flow_matches_config(flow, handler_config, is_request):
+            return handler_config, is_static
+    return None, is_static
+
 def resolve_config(flow: http.HTTPFlow, event: str) -> Optional[dict]:
     """
     Returns configuration for the event (`request` or `response`) from
     the flow state and the global mock configuration, or `None` if no
     configuration item matches the event.
+
+    The configurations matched by static handlers are cached by the event,
+    and the method, scheme, host and full path of the request.
     """
     reload_config_if_updated()
+    if event not in configured_events:
+        return None
     is_request = (event == "request")
-    path = flow.request.path.split("?")[0]
-    handlers = mock_config.get(event, {})
-    path_handler = handlers.get(flow.request.path, handlers.get(path))
-    if path_handler is None:
-        # Iterate over the regexes if there is no direct match
-        re_handlers = (re_request if is_request else re_response)
-        for path_re in re_handlers:
-            if path_re.search(flow.request.path):
-                path_handler = re_handlers[path_re]
-                break
-        if path_handler is None:
-            return None
-    config = handlers.get("*", {})
-    if isinstance(path_handler, list):
-        matched = None
-        for handler in path_handler:
-            if isinstance(config, list):
-                handler_config = {**handler}
-            else:
-                handler_config = {**config, **handler}
-            if request_matches_config(flow.request, handler_config) and (is_request or response_matches_config(flow.response, handler_config)):
-                matched = handler_config
-                break
-        if matched is None:
-            return None
-        config = matched
-    else:
-        if isinstance(config, list):
-            for handler in config:
-                handler_config = {**handler, **path_handler}
-                if request_matches_config(flow.request, handler_config) and (is_request or response_matches_config(flow.response, handler_config)):
-                    config = handler_config
-                    break
-        else:
-            config = {**config, **path_handler}
-        if not (request_matches_config(flow.request, config) and (is_request or response_matches_config(flow.response, config))):
-            return None
-    config = resolve_config_state(path, config)
+    path = request_path(flow)
+    request = flow.request
+    cache_key = (event, request.method, request.scheme, request.host, request.path)
+    try:
+        config = resolve_cache[cache_key]
+    except KeyError:
+        config, is_static = match_config(flow, event, path)
+        if is_static and (is_request or flow.response):
+            if len(resolve_cache) >= RESOLVE_CACHE_SIZE:
+                resolve_cache.clear()
+            resolve_cache[cache_key] = config
+    if config is None:
+        return None
+    if not config.get("_static"):
+        # Static handlers have no stateful handlers to resolve
+        config = resolve_config_state(path, config)
     if config.get("pass", False):
         return None
     msg = config.get("log")
     if msg:
-        if msg is True:
-            msg = "Log"
         if is_request:
-            ctx.log.info("{}: {}".format(msg, flow.request))
+            ctx.log.info(f"{msg}: {flow.request}")
         else:
-            ctx.log.info("{}: {} -> {}".format(msg, flow.request, flow.response))
+            ctx.log.info(f"{msg}: {flow.request} -> {flow.response}")
     if config.get("terminate", False):
-        ctx.log.info("Terminate {}".format(config.get("terminate")))
+        ctx.log.info(f"Terminate {config.get('terminate')}")
         ctx.master.shutdown()
     return config
 
 def save_flow(save, flow: http.HTTPFlow, event: str) -> None:
-    # TODO: Save to file(s) according to `save` definition
-    pass
+    """
+    Saves a copy of `flow` at the time of `event` by appending it to the
+    file named by `save` in the mitmproxy flow format (e.g., to be viewed
+    with `mitmproxy -r`). The copy is queued for `write_saved_flows` to
+    write in a background thread, so that the proxy is not blocked by disk
+    I/O. Any errors from writing earlier flows are logged here.
+    """
+    global save_thread
+    log_save_errors()
+    if not isinstance(save, str):
+        ctx.log.error(f"Error: invalid save: {save}")
+        return
+    if save_thread is None:
+        save_thread = threading.Thread(target=write_saved_flows, name="moxy-save", daemon=True)
+        save_thread.start()
+    save_queue.put((save, flow.copy()))
+
+def write_saved_flows() -> None:
+    """
+    Writes the flows queued by `save_flow` to their files, opening each file
+    only once for all the flows queued for it at the time, until `None` is
+    queued. Since `ctx.log` can't be used from this thread, errors are
+    queued in `save_errors` for `log_save_errors`.
+    """
+    while True:
+        saves = [ save_queue.get() ]
+        try:
+            while len(saves) < SAVE_BATCH_SIZE:
+                saves.append(save_queue.get_nowait())
+        except queue.Empty:
+            pass
+        flows_by_file = defaultdict(list)
+        for save in saves:
+            if save is not None:
+                filename, flow = save
+                flows_by_file[filename].append(flow)
+        for filename, flows in flows_by_file.items():
+            try:
+                with open(filename, "ab") as save_file:
+                    writer = io.FlowWriter(save_file)
+                    for flow in flows:
+                        try:
+                            writer.add(flow)
+                        except Exception as error:
+                            save_errors.put(f"Error: saving to {filename}: {error}")
+            except Exception as error:
+                save_errors.put(f"Error: saving to {filename}: {error}")
+        if None in saves:
+            return
+
+def log_save_errors() -> None:
+    """
+    Logs the errors queued by `write_saved_flows`.
+    """
+    try:
+        while True:
+            ctx.log.error(save_errors.get_nowait())
+    except queue.Empty:
+        pass
+
+def is_debug_logging_enabled() -> bool:
+    """
+    Returns whether debug messages are shown by mitmproxy, i.e., whether the
+    terminal or the console event log verbosity is set to `debug`. Debug
+    messages are only formatted if this is the case.
+    """
+    verbosities = [
+        getattr(ctx.options, option, None)
+        for option in ("termlog_verbosity", "console_eventlog_verbosity")
+    ]
+    verbosities = [ verbosity for verbosity in verbosities if verbosity is not None ]
+    return (not verbosities) or ("debug" in verbosities)
 
 # Called for every incoming request, before passing anything to the remote
 # server. Handling requests allows mocking data for endpoints not present
 # on remote, or modifying the outgoing request.
 def request(flow: http.HTTPFlow) -> None:
-    ctx.log.debug("Request {}: {}".format(flow.request.path, flow.request))
+    if debug_logging:
+        ctx.log.debug(f"Request {flow.request.path}: {flow.request}")
     config = resolve_config(flow, "request")
     if config is None:
         return
     required_headers = config.get("headers")
-    if required_headers and not content_matches(None, required_headers, dict(flow.request.headers)):
+    if required_headers and not headers_match(required_headers, flow.request.headers):
         return
-    ctx.log.debug("Match request {}: {}".format(flow.request.path, config))
-    save = config.get("save", mock_config.get("save"))
+    if debug_logging:
+        ctx.log.debug(f"Match request {flow.request.path}: {config}")
+    save = config.get("save", default_save)
     if save:
         save_flow(save, flow, "request")
     modify = config.get("modify")
     if modify:
-        ctx.log.debug("Modify request: {} -> {}".format(flow.request, modify))
-        flow.request.scheme = modify.get("scheme", flow.request.scheme)
-        flow.request.host = modify.get("host", flow.request.host)
-        flow.request.path = modify.get("path", flow.request.path)
-        flow.request.method = modify.get("method", flow.request.method)
+        if debug_logging:
+            ctx.log.debug(f"Modify request: {flow.request} -> {modify}")
+        if "scheme" in modify:
+            flow.request.scheme = modify["scheme"]
+        if "host" in modify:
+            flow.request.host = modify["host"]
+        if "path" in modify:
+            flow.request.path = modify["path"]
+        if "method" in modify:
+            flow.request.method = modify["method"]
         query_modifier = modify.get("query")
         if query_modifier:
             query = flow.request.query or {}
@@ -793,55 +1814,55 @@ def request(flow: http.HTTPFlow) -> None:
                 flow.request.query = content_as_object(modify_content(query_modifier, dict(query)))
             else:
                 flow.request.query = {**query, **query_modifier}
-        flow.request.headers.update(modify.get("headers", {}))
+        headers_modifier = modify.get("headers")
+        if headers_modifier:
+            flow.request.headers.update(headers_modifier)
         modifier = modify.get("content")
-        if modifier is not None:
+        if modifier is not None and not modify_encoded_content(modifier, flow.request):
             content = flow.request.text or ""
             flow.request.text = content_as_str(modify_content(modifier, content))
     response = config.get("respond")
     if response:
         flow.response = make_response(response, 200, "", {})
-        ctx.log.debug("Mock {}".format(flow.request.path))
+        if debug_logging:
+            ctx.log.debug(f"Mock {flow.request.path}")
 
 # Called before returning a response from the remote server. This can be
 # used to rewrite responses based on their original contents. For example,
 # the same endpoint may return multiple types of responses and we may wish
 # to mock only some of them, or to mock them in different ways.
 def response(flow: http.HTTPFlow) -> None:
-    ctx.log.debug("Response {}: {}".format(flow.request.path, flow.response))
+    if debug_logging:
+        ctx.log.debug(f"Response {flow.request.path}: {flow.response}")
     config = resolve_config(flow, "response")
     if config is None:
         return
     required_headers = config.get("headers")
-    if required_headers:
-        headers = {**dict(flow.request.headers), **dict(flow.response.headers)}
-        if not content_matches(None, required_headers, headers):
-            return
-    ctx.log.debug("Match response {}: {}".format(flow.request.path, config))
-    save = config.get("save", mock_config.get("save"))
+    if required_headers and not headers_match(required_headers, ChainMap(flow.response.headers, flow.request.headers)):
+        return
+    if debug_logging:
+        ctx.log.debug(f"Match response {flow.request.path}: {config}")
+    save = config.get("save", default_save)
     if save:
         save_flow(save, flow, "response")
     replace = config.get("replace")
     if replace:
-        response = replace.get("response", replace)
-        if response:
-            flow.response = make_response(response, flow.response.status_code, flow.response.content, flow.response.headers)
-            ctx.log.debug("Replace response {}: {}".format(flow.request.path, flow.response))
-    modify = config.get("modify", [])
-    if isinstance(modify, dict) or isinstance(modify, str):
-        modify = [ modify ]
-    global_modify = mock_config.get("response", {}).get("*", {}).get("modify")
-    if global_modify:
-        if isinstance(global_modify, dict) or isinstance(global_modify, str):
-            global_modify = [ global_modify ]
-        modify = global_modify + modify
+        flow.response = make_response(replace, flow.response.status_code, flow.response.content, flow.response.headers)
+        if debug_logging:
+            ctx.log.debug(f"Replace response {flow.request.path}: {flow.response}")
+    modify = config.get("modify") or []
+    if default_response_modify:
+        modify = default_response_modify + modify
     if modify:
-        flow.response.text = content_as_str(modify_content(modify, flow.response.text))
-        ctx.log.debug("Modify response {}: {}".format(flow.request.path, modify))
+        if not modify_encoded_content(modify, flow.response):
+            flow.response.text = content_as_str(modify_content(modify, flow.response.text))
+        if debug_logging:
+            ctx.log.debug(f"Modify response {flow.request.path}: {modify}")
 
 # Called when an error (inside mitmproxy, not from the remote server) occurs.
 def error(flow: http.HTTPFlow):
-    ctx.log.debug("Error {}: {}".format(flow.request.path, flow.error))
+    if debug_logging:
+        ctx.log.debug(f"Error {flow.request.path}: {flow.error}")
 
 # Called when the script is loaded, registers command-line options.
 def load(script) -> None:
@@ -849,29 +1870,169 @@ def load(script) -> None:
 
 # Called to configure the script.
 def configure(updated) -> None:
+    global debug_logging
+    debug_logging = is_debug_logging_enabled()
     if "mock" in updated:
+        watch_config_file(ctx.options.mock)
         load_config_file(ctx.options.mock)
 
+# Called when the script is unloaded or mitmproxy shuts down.
+def done() -> None:
+    global save_thread, config_watcher
+    if config_watcher is not None:
+        config_watcher.stop()
+        config_watcher.join()
+        config_watcher = None
+    if save_thread is not None:
+        # Finish writing the saved flows, but don't hold up the shutdown
+        save_queue.put(None)
+        save_thread.join(SAVE_DONE_TIMEOUT)
+        save_thread = None
+    log_save_errors()
+
+# Matches the start of JSON content that may match a dictionary (see `content_matches`).
+JSON_START_RE = re.compile(r"\s*[\[{]")
+
+# Matches the syntax that prevents combining a regular expression with others
+# into a single alternation: backreferences and conditionals (which refer to
+# group numbers), and global inline flags (which would apply to all of them).
+UNCOMBINABLE_RE_SYNTAX_RE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)")
+
+# Matches the characters that are treated differently in verbose mode.
+VERBOSE_SYNTAX_RE = re.compile(r"[\s#]")
+
+# Matches regular expressions consisting only of literal ASCII characters
+# (see `compile_substitution`).
+LITERAL_ASCII_RE = re.compile(r"(?:[A-Za-z0-9_\"',:;/=@%&!<>`~-]|\\[^A-Za-z0-9\s])*\Z")
+
+# Charsets in which ASCII characters are encoded as themselves.
+ASCII_COMPATIBLE_CHARSETS = frozenset((
+    "utf-8", "utf8", "us-ascii", "ascii", "iso-8859-1", "latin-1", "latin1",
+))
+
 # The global configuration.
 mock_config = {}
 
+# Whether debug messages are logged (see `is_debug_logging_enabled`).
+debug_logging = True
+
+# The global `save` setting, used unless overridden by the handler.
+default_save = None
+
+# The global `charset` setting, used unless overridden by the response.
+default_charset = "utf-8"
+
+# The `modify` list of the default response handler (`*`), applied to all responses.
+default_response_modify = None
+
+# Whether any exact path of the event (`request` or `response`) includes a query.
+query_paths = {}
+
+# The events (`request` and `response`) that have any handlers configured.
+configured_events = frozenset()
+
 # The global state (can be set and matched by rules).
 mock_state = {}
 
-# Compiled regular expressions indexed by string.
-re_cache = {}
+# The compiled matcher for the global `host` (see `compile_host_matcher`).
+default_host_matcher = None
+
+# The global `scheme` (see `compile_scheme_matcher`).
+default_scheme = None
+
+# Bits for the schemes in a compiled `scheme` matcher.
+SCHEME_BITS = { "http": 1, "https": 2 }
+
+# Functions matching a value by the class of the allowed value (see
+# `matches_value_or_list`).
+VALUE_MATCHERS = {
+    frozenset: matches_value_in_set,
+    re.Pattern: matches_value_pattern,
+    str: matches_value_str,
+    dict: matches_value_dict,
+    list: matches_value_in_list,
+}
+
+# Content types by file extension (others are assumed to be JSON).
+EXTENSION_CONTENT_TYPES = {
+    ".html": "text/html",
+    ".htm": "text/html",
+    ".xhtml": "application/xhtml+xml",
+    ".xml": "text/xml",
+    ".txt": "text/plain",
+    ".md": "text/plain",
+    ".js": "application/javascript",
+    ".json": "application/json",
+}
+
+# File contents as ((modification time, size), bytes, content type) indexed by name.
+file_cache = {}
+
+# Regex paths for requests as tuples of the compiled regex and the handler.
+re_request = []
+
+# Regex paths for responses as tuples of the compiled regex and the handler.
+re_response = []
+
+# Regex paths for requests combined by `compile_path_union`.
+re_request_union = None
+
+# Regex paths for responses combined by `compile_path_union`.
+re_response_union = None
+
+# Handler keys that make the handler depend on more than the request
+# method, scheme, host and path (see `is_static_handler`).
+DYNAMIC_HANDLER_KEYS = (
+    "request", "require", "status", "error", "content",
+    "set", "once", "count", "cycle", "random", "state",
+)
 
-# Regex paths for requests.
-re_request = OrderedDict()
+# Cached results of matching static handlers (see `resolve_config`).
+resolve_cache = {}
 
-# Regex paths for responses.
-re_response = OrderedDict()
+# The maximum number of entries in `resolve_cache` before it is cleared.
+RESOLVE_CACHE_SIZE = 4096
 
-# Hit counters (for `count` and `once`).
-hit_count = {}
+# Hit counters (for `count` and `once`), each yielding the next count from 1.
+hit_count = defaultdict(lambda: itertools.count(1))
+
+# The random number generator (for `random`).
+random_generator = random.Random()
 
 # Round-robin cycle indices (for `cycle`).
 cycle_index = {}
 
-# The modification time of the config file.
+# The modification time of the config file (in nanoseconds).
 config_modified_at = None
+
+# The monotonic time when the modification time was last checked.
+config_checked_at = 0.0
+
+# The minimum interval between checks of the modification time (in seconds).
+RELOAD_CHECK_INTERVAL = 1.0
+
+# Flows to save as tuples of the file name and the flow (see `save_flow`).
+save_queue = queue.SimpleQueue()
+
+# Errors from writing the saved flows, to be logged by `log_save_errors`.
+save_errors = queue.SimpleQueue()
+
+# The thread writing the saved flows, started when the first flow is saved.
+save_thread = None
+
+# The maximum number of saved flows written at once.
+SAVE_BATCH_SIZE = 100
+
+# The maximum time to wait for the saved flows to be written on shutdown (in seconds).
+SAVE_DONE_TIMEOUT = 5.0
+
+# The keys added to the handler dictionaries when compiling them.
+INTERNAL_HANDLER_KEYS = frozenset((
+    "_host", "_query", "_static", "_static_path", "_match_request", "_match_status",
+))
+
+# The `watchdog` observer of the configuration file, if it is watched.
+config_watcher = None
+
+# Whether the watched configuration file may have changed.
+config_changed = False